@@ -3,7 +3,13 @@ import time
 import os
 import re
 import random
+import threading
+import json
+import hashlib
+import itertools
+from array import array
 from datetime import datetime
+from typing import NamedTuple
 from dotenv import load_dotenv
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
@@ -18,10 +24,24 @@ SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 RANGE_NAME = os.getenv("RANGE_NAME")
 REPORT_SPREADSHEET_ID = os.getenv("REPORT_SPREADSHEET_ID")
+REPORTS_DIR = os.getenv("REPORTS_DIR", "reports")
+REPORT_BATCH_SIZE = int(os.getenv("REPORT_BATCH_SIZE", "20"))
+REPORT_KEEP_SHEETS = int(os.getenv("REPORT_KEEP_SHEETS", "30"))
+REPORT_SUMMARY_SHEET = "Сводка"
+ARCHIVE_BATCH_GET_SIZE = 50
+STOP_LIST_FILE = os.getenv("STOP_LIST_FILE", "stop_list.txt")
+STOP_LIST_SPREADSHEET_ID = os.getenv("STOP_LIST_SPREADSHEET_ID") or SPREADSHEET_ID
+STOP_LIST_RANGE = os.getenv("STOP_LIST_RANGE")
+WEBHOOK_TOKEN = os.getenv("WEBHOOK_TOKEN")
 
 # Настройки по умолчанию для веб-интерфейса
 DEFAULT_MESSAGE_TEXT = ""
 DEFAULT_DELAY_BETWEEN_MESSAGES = 5
+DEFAULT_CAMPAIGN_PRIORITY = 0
+DEFAULT_CAMPAIGN_WEIGHT = 1
+
+# Уровни приоритета рассылок: кампания с большим приоритетом обслуживается первой
+CAMPAIGN_PRIORITIES = {0: "Обычный", 1: "Высокий", 2: "Срочный"}
 
 # Области доступа для Google Sheets API
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
@@ -36,7 +56,26 @@ def log_message(logs_list, message, level="info"):
     logs_list.append({"message": message, "level": level})
 
 
+def normalize_phone_number(raw_number):
+    """Приводит номер к виду 7XXXXXXXXXX без записи в логи. Возвращает строку или None."""
+    raw_number = str(raw_number).strip()
+    if (
+        len(raw_number) == 11
+        and raw_number[0] == "7"
+        and raw_number.isascii()
+        and raw_number.isdigit()
+    ):
+        return raw_number  # Уже в нужном формате
+    digits = re.sub(r"\D", "", raw_number)
+    if len(digits) == 11 and digits[0] in "78":
+        return "7" + digits[1:]
+    if len(digits) == 10:
+        return "7" + digits
+    return None
+
+
 def format_phone_number(raw_number, logs_list):
+    """Приводит номер к виду 7XXXXXXXXXX (правила — в normalize_phone_number) и пишет в логи, что с ним сделано."""
     if not isinstance(raw_number, str):
         log_message(
             logs_list,
@@ -44,43 +83,38 @@ def format_phone_number(raw_number, logs_list):
             "warning",
         )
         return None
+    formatted = normalize_phone_number(raw_number)
     digits = re.sub(r"\D", "", raw_number)
-    if len(digits) == 11:
-        if digits.startswith("8"):
-            formatted = "7" + digits[1:]
+    if formatted is None:
+        if len(digits) == 11:
             log_message(
                 logs_list,
-                f"    Форматирование: '{raw_number}' -> '{formatted}' (Замена 8 на 7)",
-            )
-            return formatted
-        elif digits.startswith("7"):
-            log_message(
-                logs_list,
-                f"    Форматирование: '{raw_number}' -> '{digits}' (Уже верный формат)",
+                f"  Предупреждение: Номер '{raw_number}' -> '{digits}' имеет 11 цифр, но начинается не с 7 или 8. Пропускаем.",
+                "warning",
             )
-            return digits
         else:
             log_message(
                 logs_list,
-                f"  Предупреждение: Номер '{raw_number}' -> '{digits}' имеет 11 цифр, но начинается не с 7 или 8. Пропускаем.",
+                f"  Предупреждение: Номер '{raw_number}' -> '{digits}' имеет неверную длину ({len(digits)}). Пропускаем.",
                 "warning",
             )
-            return None
     elif len(digits) == 10:
-        formatted = "7" + digits
         log_message(
             logs_list,
             f"  Предупреждение: Номер '{raw_number}' -> '{digits}' имеет 10 цифр. Добавляем '7' в начало -> '{formatted}'",
             "warning",
         )
-        return formatted
+    elif digits.startswith("8"):
+        log_message(
+            logs_list,
+            f"    Форматирование: '{raw_number}' -> '{formatted}' (Замена 8 на 7)",
+        )
     else:
         log_message(
             logs_list,
-            f"  Предупреждение: Номер '{raw_number}' -> '{digits}' имеет неверную длину ({len(digits)}). Пропускаем.",
-            "warning",
+            f"    Форматирование: '{raw_number}' -> '{digits}' (Уже верный формат)",
         )
-        return None
+    return formatted
 
 
 def get_phone_numbers_from_sheet(service, source_spreadsheet_id, range_name, logs_list):
@@ -97,6 +131,7 @@ def get_phone_numbers_from_sheet(service, source_spreadsheet_id, range_name, log
         )
         values = result.get("values", [])
         formatted_numbers = []
+        seen_numbers = set()  # Для проверки дубликатов за O(1)
         if not values:
             log_message(
                 logs_list,
@@ -123,7 +158,8 @@ def get_phone_numbers_from_sheet(service, source_spreadsheet_id, range_name, log
                     )
                     formatted = format_phone_number(raw_number, logs_list)
                     if formatted:
-                        if formatted not in formatted_numbers:
+                        if formatted not in seen_numbers:
+                            seen_numbers.add(formatted)
                             formatted_numbers.append(formatted)
                             log_message(
                                 logs_list,
@@ -165,56 +201,147 @@ def get_phone_numbers_from_sheet(service, source_spreadsheet_id, range_name, log
         return None
 
 
+# Статусы отправки (используются в результатах рассылки и в отчетах)
+REPORT_STATUS_FAILED = 0
+REPORT_STATUS_SENT = 1
+REPORT_STATUS_SKIPPED = 2
+REPORT_STATUS_OPTED_OUT = 3
+REPORT_STATUS_TITLES = {
+    REPORT_STATUS_FAILED: "Не отправлено",
+    REPORT_STATUS_SENT: "Отправлено",
+    REPORT_STATUS_SKIPPED: "Пропущено (дубликат)",
+    REPORT_STATUS_OPTED_OUT: "Пропущено (стоп-лист)",
+}
+
+
+class SendResult(NamedTuple):
+    """Результат отправки одного сообщения. Тело ответа API хранится только при ошибке."""
+
+    number: str
+    status: int
+    http_code: int
+    latency: float
+    message_id: str
+    error: str = ""
+
+
+def decode_error_body(response):
+    """Декодирует тело ответа API (нужно только для сообщений об ошибках)."""
+    return response.content.decode("utf-8", errors="replace")
+
+
 def send_message(api_url, phone_number, message, logs_list):
     chat_id = f"{phone_number}@c.us"
     payload = {"chatId": chat_id, "message": message}
     headers = {"Content-Type": "application/json"}
+    started = time.perf_counter()
     try:
         log_message(logs_list, f"Отправка сообщения на {chat_id}...")
         response = requests.post(api_url, json=payload, headers=headers, timeout=60)
+        latency = time.perf_counter() - started
         response.raise_for_status()
-        response_text = "Не удалось декодировать ответ API"
+        # Ответ API — небольшой JSON в UTF-8: разбираем байты напрямую, без перекодирования текста
+        message_id = ""
         try:
-            response_text = response.text.encode("latin1").decode("utf8")
-        except UnicodeDecodeError:
-            try:
-                response_text = response.text.encode("utf-8").decode("utf-8")
-            except Exception:
-                response_text = response.text
+            message_id = str(json.loads(response.content).get("idMessage", ""))
+        except (ValueError, AttributeError):
+            pass
         log_message(
             logs_list,
-            f"  Успешно отправлено на {chat_id}. Ответ API: {response_text}",
+            f"  Успешно отправлено на {chat_id} за {latency:.2f} сек. ID сообщения: {message_id or 'нет'}",
             "success",
         )
-        return True
+        return SendResult(
+            phone_number, REPORT_STATUS_SENT, response.status_code, latency, message_id
+        )
     except requests.exceptions.Timeout:
-        log_message(
-            logs_list,
-            f"  Ошибка: Превышено время ожидания ответа от API при отправке на {chat_id}.",
-            "error",
+        error_msg = f"  Ошибка: Превышено время ожидания ответа от API при отправке на {chat_id}."
+        log_message(logs_list, error_msg, "error")
+        return SendResult(
+            phone_number,
+            REPORT_STATUS_FAILED,
+            0,
+            time.perf_counter() - started,
+            "",
+            error_msg.strip(),
         )
-        return False
     except requests.exceptions.RequestException as e:
         error_msg = f"  Ошибка отправки на {chat_id}: {e}"
-        response_text = ""
+        http_code = 0
         if e.response is not None:
-            try:
-                response_text = e.response.text.encode("latin1").decode("utf8")
-            except UnicodeDecodeError:
-                try:
-                    response_text = e.response.text.encode("utf-8").decode("utf-8")
-                except Exception:
-                    response_text = e.response.text
-            error_msg += f" | Ответ сервера ({e.response.status_code}): {response_text}"
+            http_code = e.response.status_code
+            error_msg += f" | Ответ сервера ({http_code}): {decode_error_body(e.response)}"
         log_message(logs_list, error_msg, "error")
-        return False
+        return SendResult(
+            phone_number,
+            REPORT_STATUS_FAILED,
+            http_code,
+            time.perf_counter() - started,
+            "",
+            error_msg.strip(),
+        )
     except Exception as e:
-        log_message(
-            logs_list,
-            f"  Непредвиденная ошибка при отправке на {chat_id}: {e}",
-            "error",
+        error_msg = f"  Непредвиденная ошибка при отправке на {chat_id}: {e}"
+        log_message(logs_list, error_msg, "error")
+        return SendResult(
+            phone_number,
+            REPORT_STATUS_FAILED,
+            0,
+            time.perf_counter() - started,
+            "",
+            error_msg.strip(),
         )
-        return False
+
+
+def create_send_results():
+    """Создает компактное хранилище результатов рассылки.
+
+    Поля результатов хранятся в типизированных массивах (около 19 байт на
+    сообщение плюс ID сообщения), тексты ошибок — только для неудачных отправок.
+    """
+    return {
+        "numbers": array("q"),
+        "statuses": array("B"),
+        "http_codes": array("H"),
+        "latencies": array("f"),
+        "message_ids": bytearray(),
+        "message_id_ends": array("I"),
+        "errors": {},
+    }
+
+
+def append_send_result(results, result):
+    """Добавляет SendResult в хранилище результатов рассылки."""
+    index = len(results["statuses"])
+    results["numbers"].append(int(result.number))
+    results["statuses"].append(result.status)
+    results["http_codes"].append(result.http_code)
+    results["latencies"].append(result.latency)
+    results["message_ids"] += result.message_id.encode("ascii", errors="replace")
+    results["message_id_ends"].append(len(results["message_ids"]))
+    if result.error:
+        results["errors"][index] = result.error
+
+
+def summarize_send_results(results):
+    """Считает итоги рассылки по массивам результатов."""
+    statuses = results["statuses"]
+    # Пропущенные сообщения не обращались к API — в среднее время ответа не входят
+    api_latencies = [
+        latency
+        for status, latency in zip(statuses, results["latencies"])
+        if status == REPORT_STATUS_SENT or status == REPORT_STATUS_FAILED
+    ]
+    return {
+        "total": len(statuses),
+        "successful_sends": statuses.count(REPORT_STATUS_SENT),
+        "failed_sends": statuses.count(REPORT_STATUS_FAILED),
+        "skipped_sends": statuses.count(REPORT_STATUS_SKIPPED)
+        + statuses.count(REPORT_STATUS_OPTED_OUT),
+        "average_latency": round(sum(api_latencies) / len(api_latencies), 3)
+        if api_latencies
+        else 0,
+    }
 
 
 def create_google_service(logs_list):
@@ -356,6 +483,1058 @@ def write_report_to_sheet(
         return False
 
 
+# --- Локальное хранилище отчетов ---
+# Каждая рассылка хранится в папке REPORTS_DIR/<имя листа>/ в виде
+# столбцов, которые только дописываются: по одному бинарному файлу на
+# столбец (модуль array). Строка отчета занимает 21 байт, а весь столбец
+# читается одним вызовом fromfile, поэтому сводки считаются быстро.
+# Список рассылок ведется в REPORTS_DIR/index.jsonl.
+REPORT_TITLE_FORMAT = "%d.%m.%y %H-%M-%S"
+# Рассылки, запущенные в одну секунду, получают суффикс: "19.10.26 12-00-00 (2)"
+REPORT_TITLE_RE = re.compile(r"^(?P<base>.+?)(?: \((?P<suffix>\d+)\))?$")
+REPORT_COLUMNS = {
+    "row": "I",  # № п/п
+    "number": "q",  # Номер телефона
+    "status": "B",  # см. REPORT_STATUS_TITLES
+    "sent_at": "d",  # Время отправки (unix time)
+}
+summary_sheet_spreadsheets = set()  # Таблицы, в которых лист сводки уже есть
+REPORT_SUMMARY_HEADER = [
+    "Лист",
+    "Всего",
+    "Отправлено",
+    "Не отправлено",
+    "Пропущено",
+    "Успешно, %",
+    "Начало",
+    "Окончание",
+]
+
+
+def parse_report_title(report_title):
+    """Разбирает имя отчета в ключ сортировки (дата запуска, суффикс).
+
+    Бросает ValueError, если имя не является именем отчета.
+    """
+    match = REPORT_TITLE_RE.match(report_title)
+    if not match:
+        raise ValueError(report_title)
+    started = datetime.strptime(match["base"], REPORT_TITLE_FORMAT)
+    return started, int(match["suffix"] or 1)
+
+
+def reserve_local_report(message_text, total, logs_list):
+    """Подбирает уникальное имя отчета для новой рассылки и регистрирует его.
+
+    Папка отчета создается через os.mkdir, поэтому две рассылки, запущенные
+    в одну секунду, не получат одно и то же имя (и общий лист и файл логов).
+    """
+    base_title = datetime.now().strftime(REPORT_TITLE_FORMAT)
+    report_title = base_title
+    suffix = 1
+    try:
+        os.makedirs(REPORTS_DIR, exist_ok=True)
+        while True:
+            try:
+                os.mkdir(os.path.join(REPORTS_DIR, report_title))
+                break
+            except FileExistsError:
+                suffix += 1
+                report_title = f"{base_title} ({suffix})"
+    except OSError as e:
+        log_message(
+            logs_list,
+            f"Ошибка создания папки локального отчета '{report_title}': {e}",
+            "error",
+        )
+        return report_title
+    register_local_report(report_title, message_text, total, logs_list)
+    return report_title
+
+
+def append_local_report_index(entry):
+    """Дописывает запись в индекс локальных отчетов REPORTS_DIR/index.jsonl."""
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    with open(os.path.join(REPORTS_DIR, "index.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def register_local_report(report_title, message_text, total, logs_list):
+    """Добавляет рассылку в индекс локальных отчетов."""
+    try:
+        os.makedirs(os.path.join(REPORTS_DIR, report_title), exist_ok=True)
+        append_local_report_index(
+            {
+                "title": report_title,
+                "created_at": time.time(),
+                "total": total,
+                "message": message_text,
+            }
+        )
+        return True
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Ошибка регистрации локального отчета '{report_title}': {e}",
+            "error",
+        )
+        return False
+
+
+def record_local_report_summary(report_title, summary, logs_list):
+    """Сохраняет в индексе итоговую сводку завершенной рассылки.
+
+    Сводка пишется один раз, поэтому выгрузка сводки и /reports читают только
+    индекс и не перечитывают столбцы всех отчетов.
+    """
+    try:
+        append_local_report_index({"title": report_title, "summary": summary})
+        return True
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Ошибка записи сводки локального отчета '{report_title}': {e}",
+            "error",
+        )
+        return False
+
+
+def list_local_reports():
+    """Возвращает записи индекса локальных отчетов (без повторов, сначала новые).
+
+    Сводка завершенной рассылки доступна в поле "summary". Поврежденные строки
+    индекса (например, недописанные при сбое) пропускаются.
+    """
+    index_path = os.path.join(REPORTS_DIR, "index.jsonl")
+    reports = {}
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                title = entry["title"]
+                parse_report_title(title)
+            except (ValueError, TypeError, KeyError):
+                continue
+            report = reports.setdefault(title, {"title": title})
+            if isinstance(entry.get("summary"), dict):
+                report["summary"] = entry["summary"]
+            else:
+                for key, value in entry.items():
+                    report.setdefault(key, value)
+    return sorted(
+        reports.values(),
+        key=lambda entry: parse_report_title(entry["title"]),
+        reverse=True,
+    )
+
+
+def report_entry_summary(entry):
+    """Возвращает сводку из записи индекса; для незавершенной рассылки — только общее число."""
+    if "summary" in entry:
+        return entry["summary"]
+    return {
+        "title": entry["title"],
+        "total": entry.get("total", 0),
+        "successful_sends": None,
+        "failed_sends": None,
+        "skipped_sends": None,
+        "success_rate": None,
+        "started_at": None,
+        "finished_at": None,
+    }
+
+
+def append_local_report_rows(report_title, rows, logs_list):
+    """Дописывает строки (№, номер, отправлено, время) в столбцы локального отчета."""
+    try:
+        report_dir = os.path.join(REPORTS_DIR, report_title)
+        os.makedirs(report_dir, exist_ok=True)
+        for column_index, (column, typecode) in enumerate(REPORT_COLUMNS.items()):
+            values = array(typecode, (row[column_index] for row in rows))
+            with open(os.path.join(report_dir, f"{column}.bin"), "ab") as f:
+                values.tofile(f)
+        return True
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Ошибка записи в локальный отчет '{report_title}': {e}",
+            "error",
+        )
+        return False
+
+
+def read_local_report(report_title):
+    """Читает столбцы локального отчета в массивы array."""
+    report_dir = os.path.join(REPORTS_DIR, report_title)
+    columns = {}
+    for column, typecode in REPORT_COLUMNS.items():
+        values = array(typecode)
+        path = os.path.join(report_dir, f"{column}.bin")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                values.frombytes(f.read())
+        columns[column] = values
+    # Если запись последней строки прервалась, обрезаем столбцы до общей длины
+    length = min(len(values) for values in columns.values())
+    for column, values in columns.items():
+        del values[length:]
+    return columns
+
+
+def build_report_summary(report_title, statuses, started_at, finished_at):
+    """Считает сводку рассылки по статусам ее сообщений."""
+    total = len(statuses)
+    sent = statuses.count(REPORT_STATUS_SENT)
+    failed = statuses.count(REPORT_STATUS_FAILED)
+    return {
+        "title": report_title,
+        "total": total,
+        "successful_sends": sent,
+        "failed_sends": failed,
+        "skipped_sends": total - sent - failed,
+        "success_rate": round(sent * 100 / total, 1) if total else 0,
+        "started_at": started_at,
+        "finished_at": finished_at,
+    }
+
+
+def summarize_local_report(report_title):
+    """Считает сводку по столбцам локального отчета."""
+    columns = read_local_report(report_title)
+    sent_at = columns["sent_at"]
+    return build_report_summary(
+        report_title,
+        columns["status"],
+        min(sent_at) if sent_at else None,
+        max(sent_at) if sent_at else None,
+    )
+
+
+def ensure_summary_sheet(service, target_spreadsheet_id, logs_list):
+    """Создает лист сводки, если его еще нет. Наличие листа кэшируется."""
+    if target_spreadsheet_id in summary_sheet_spreadsheets:
+        return True
+    try:
+        spreadsheet = (
+            service.spreadsheets()
+            .get(spreadsheetId=target_spreadsheet_id, fields="sheets.properties.title")
+            .execute()
+        )
+        titles = {
+            sheet["properties"]["title"] for sheet in spreadsheet.get("sheets", [])
+        }
+    except HttpError as err:
+        log_message(
+            logs_list,
+            f"Ошибка Google API при получении списка листов (таблица ID: {target_spreadsheet_id}): {err}",
+            "error",
+        )
+        return False
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Непредвиденная ошибка при получении списка листов (таблица ID: {target_spreadsheet_id}): {e}",
+            "error",
+        )
+        return False
+    if REPORT_SUMMARY_SHEET not in titles and not create_new_report_sheet(
+        service, target_spreadsheet_id, REPORT_SUMMARY_SHEET, logs_list
+    ):
+        return False
+    summary_sheet_spreadsheets.add(target_spreadsheet_id)
+    return True
+
+
+def export_reports_summary(service, target_spreadsheet_id, logs_list):
+    """Одним запросом перезаписывает лист сводки по всем локальным отчетам."""
+
+    def format_time(timestamp):
+        if timestamp is None:
+            return ""
+        return datetime.fromtimestamp(timestamp).strftime("%d.%m.%y %H:%M:%S")
+
+    def format_value(value):
+        return "" if value is None else value
+
+    if not ensure_summary_sheet(service, target_spreadsheet_id, logs_list):
+        return False
+    data_rows = [REPORT_SUMMARY_HEADER]
+    for entry in list_local_reports():
+        summary = report_entry_summary(entry)
+        data_rows.append(
+            [
+                entry["title"],
+                summary["total"],
+                format_value(summary["successful_sends"]),
+                format_value(summary["failed_sends"]),
+                format_value(summary["skipped_sends"]),
+                format_value(summary["success_rate"]),
+                format_time(summary["started_at"]),
+                format_time(summary["finished_at"]),
+            ]
+        )
+    try:
+        service.spreadsheets().values().update(
+            spreadsheetId=target_spreadsheet_id,
+            range=f"'{REPORT_SUMMARY_SHEET}'!A1",
+            valueInputOption="USER_ENTERED",
+            body={"values": data_rows},
+        ).execute()
+        log_message(
+            logs_list,
+            f"Сводка по {len(data_rows) - 1} рассылкам выгружена на лист '{REPORT_SUMMARY_SHEET}' (таблица ID: {target_spreadsheet_id}).",
+        )
+        return True
+    except HttpError as err:
+        # Лист могли удалить вручную — при следующей выгрузке проверим заново
+        summary_sheet_spreadsheets.discard(target_spreadsheet_id)
+        log_message(
+            logs_list,
+            f"Ошибка Google API при выгрузке сводки (таблица ID: {target_spreadsheet_id}): {err}",
+            "error",
+        )
+        return False
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Непредвиденная ошибка при выгрузке сводки (таблица ID: {target_spreadsheet_id}): {e}",
+            "error",
+        )
+        return False
+
+
+def parse_sheet_report_rows(sheet_title, values):
+    """Преобразует строки листа отчета [№, Number, Name, Status, Time] в строки локального отчета."""
+    report_date = parse_report_title(sheet_title)[0].date()
+    statuses = {title: status for status, title in REPORT_STATUS_TITLES.items()}
+    rows = []
+    for row in values[1:]:  # Первая строка — заголовок
+        try:
+            sent_time = datetime.strptime(str(row[4]), "%H:%M:%S").time()
+            rows.append(
+                (
+                    int(row[0]),
+                    int(re.sub(r"\D", "", str(row[1]))),
+                    statuses.get(row[3], REPORT_STATUS_FAILED),
+                    datetime.combine(report_date, sent_time).timestamp(),
+                )
+            )
+        except (IndexError, ValueError):
+            continue
+    return rows
+
+
+def archive_old_report_sheets(service, target_spreadsheet_id, keep, logs_list):
+    """Архивирует старые листы отчетов: переносит их данные в локальное
+    хранилище и удаляет листы одним запросом batchUpdate.
+
+    Всегда остается хотя бы один (самый новый) лист, а листы рассылок,
+    которые еще выполняются, не трогаются. Возвращает количество удаленных
+    листов или None при ошибке.
+    """
+    keep = max(1, keep)
+    with dispatch_condition:
+        active_titles = {c["report_sheet_title"] for c in campaign_queue}
+    try:
+        spreadsheet = (
+            service.spreadsheets()
+            .get(
+                spreadsheetId=target_spreadsheet_id,
+                fields="sheets.properties(sheetId,title)",
+            )
+            .execute()
+        )
+        report_sheets = []
+        for sheet in spreadsheet.get("sheets", []):
+            properties = sheet["properties"]
+            try:
+                created = parse_report_title(properties["title"])
+            except ValueError:
+                continue  # Не лист отчета (например, лист сводки)
+            if properties["title"] in active_titles:
+                continue  # Рассылка еще пишет в этот лист
+            report_sheets.append((created, properties))
+        report_sheets.sort(key=lambda item: item[0], reverse=True)
+        old_sheets = [properties for _, properties in report_sheets[keep:]]
+        if not old_sheets:
+            log_message(
+                logs_list,
+                f"Архивация: листов отчетов {len(report_sheets)}, старых листов (сверх {keep}) нет.",
+            )
+            return 0
+
+        local_titles = {entry["title"] for entry in list_local_reports()}
+        to_import = [p["title"] for p in old_sheets if p["title"] not in local_titles]
+        # batchGet — GET-запрос с диапазонами в URL, поэтому читаем пачками
+        for start in range(0, len(to_import), ARCHIVE_BATCH_GET_SIZE):
+            chunk = to_import[start : start + ARCHIVE_BATCH_GET_SIZE]
+            result = (
+                service.spreadsheets()
+                .values()
+                .batchGet(
+                    spreadsheetId=target_spreadsheet_id,
+                    ranges=[f"'{title}'!A:E" for title in chunk],
+                )
+                .execute()
+            )
+            value_ranges = result.get("valueRanges", [])
+            if len(value_ranges) != len(chunk):
+                log_message(
+                    logs_list,
+                    f"Архивация прервана: API вернул {len(value_ranges)} диапазонов вместо {len(chunk)}. Листы не удалены.",
+                    "error",
+                )
+                return None
+            for title, value_range in zip(chunk, value_ranges):
+                rows = parse_sheet_report_rows(title, value_range.get("values", []))
+                # Лист попадает в индекс только после записи всех его строк
+                if rows and not append_local_report_rows(title, rows, logs_list):
+                    return None
+                if not register_local_report(title, "", len(rows), logs_list):
+                    return None
+                sent_at = [row[3] for row in rows]
+                record_local_report_summary(
+                    title,
+                    build_report_summary(
+                        title,
+                        [row[2] for row in rows],
+                        min(sent_at) if sent_at else None,
+                        max(sent_at) if sent_at else None,
+                    ),
+                    logs_list,
+                )
+
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=target_spreadsheet_id,
+            body={
+                "requests": [
+                    {"deleteSheet": {"sheetId": p["sheetId"]}} for p in old_sheets
+                ]
+            },
+        ).execute()
+        log_message(
+            logs_list,
+            f"Архивировано листов отчетов: {len(old_sheets)} (перенесено в локальное хранилище: {len(to_import)}).",
+            "success",
+        )
+        return len(old_sheets)
+    except HttpError as err:
+        log_message(
+            logs_list,
+            f"Ошибка Google API при архивации листов (таблица ID: {target_spreadsheet_id}): {err}",
+            "error",
+        )
+        return None
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Непредвиденная ошибка при архивации листов (таблица ID: {target_spreadsheet_id}): {e}",
+            "error",
+        )
+        return None
+
+
+# --- Защита от повторных отправок ---
+# Для каждого сообщения вычисляется ключ идемпотентности из ключа кампании
+# (источник номеров + хэш текста) и номера. Отправленные ключи хранятся в
+# словаре (проверка O(1)) и дописываются в файл REPORTS_DIR/sent_keys.log,
+# чтобы переживать перезапуск приложения.
+SEND_DEDUP_WINDOW = int(os.getenv("SEND_DEDUP_WINDOW", str(24 * 60 * 60)))
+CAMPAIGN_DEDUP_WINDOW = int(os.getenv("CAMPAIGN_DEDUP_WINDOW", str(10 * 60)))
+SENT_KEYS_PRUNE_INTERVAL = 1000
+sent_keys = None
+sent_keys_inserts = 0
+sent_keys_lock = threading.Lock()
+campaign_submissions = {}
+
+
+def make_campaign_key(source_spreadsheet_id, range_name, message_text):
+    """Ключ кампании: одинаков для одинакового текста и источника номеров."""
+    message_hash = hashlib.sha256(message_text.encode("utf-8")).hexdigest()
+    source = f"{source_spreadsheet_id}!{range_name}"
+    return hashlib.blake2b(
+        f"{source}\n{message_hash}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def make_send_key(campaign_key, phone_number):
+    """Ключ идемпотентности отдельного сообщения (кампания, номер, хэш текста)."""
+    return hashlib.blake2b(
+        f"{campaign_key}:{phone_number}".encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+
+def sent_keys_path():
+    return os.path.join(REPORTS_DIR, "sent_keys.log")
+
+
+def compact_sent_keys():
+    """Удаляет истекшие ключи из памяти и перезаписывает файл только с живыми
+    ключами (вызывать под sent_keys_lock)."""
+    expire_before = time.time() - SEND_DEDUP_WINDOW
+    for key in [key for key, sent_at in sent_keys.items() if sent_at < expire_before]:
+        del sent_keys[key]
+    path = sent_keys_path()
+    tmp_path = path + ".tmp"
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("".join(f"{key} {sent_at}\n" for key, sent_at in sent_keys.items()))
+    os.replace(tmp_path, path)
+
+
+def load_sent_keys():
+    """Загружает неистекшие ключи отправленных сообщений (вызывать под sent_keys_lock)."""
+    global sent_keys
+    sent_keys = {}
+    path = sent_keys_path()
+    if not os.path.exists(path):
+        return
+    expire_before = time.time() - SEND_DEDUP_WINDOW
+    stale_lines = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                key, sent_at = line.split()
+                sent_at = float(sent_at)
+            except ValueError:
+                stale_lines += 1
+                continue
+            if sent_at >= expire_before:
+                sent_keys[key] = sent_at
+            else:
+                stale_lines += 1
+    if stale_lines:
+        try:
+            compact_sent_keys()
+        except OSError as e:
+            print(f"Предупреждение: не удалось сжать файл ключей отправки {path}: {e}")
+
+
+def is_already_sent(send_key):
+    """Проверяет, отправлялось ли сообщение с этим ключом в пределах окна."""
+    with sent_keys_lock:
+        if sent_keys is None:
+            load_sent_keys()
+        sent_at = sent_keys.get(send_key)
+    return sent_at is not None and time.time() - sent_at < SEND_DEDUP_WINDOW
+
+
+def mark_sent(send_key, logs_list):
+    """Запоминает ключ успешно отправленного сообщения.
+
+    Каждые SENT_KEYS_PRUNE_INTERVAL вставок истекшие ключи удаляются из
+    памяти и из файла.
+    """
+    global sent_keys_inserts
+    sent_at = time.time()
+    with sent_keys_lock:
+        if sent_keys is None:
+            load_sent_keys()
+        sent_keys[send_key] = sent_at
+        sent_keys_inserts += 1
+        try:
+            if sent_keys_inserts % SENT_KEYS_PRUNE_INTERVAL == 0:
+                compact_sent_keys()
+            else:
+                os.makedirs(REPORTS_DIR, exist_ok=True)
+                with open(sent_keys_path(), "a", encoding="utf-8") as f:
+                    f.write(f"{send_key} {sent_at}\n")
+        except Exception as e:
+            log_message(
+                logs_list,
+                f"  Предупреждение: не удалось сохранить ключ отправки в файл: {e}",
+                "warning",
+            )
+
+
+def claim_campaign_submission(campaign_key):
+    """Регистрирует запуск рассылки.
+
+    Возвращает (запуск, дубликат). Если такая же рассылка уже выполняется или
+    завершилась не раньше CAMPAIGN_DEDUP_WINDOW секунд назад, возвращается
+    существующий запуск и дубликат=True.
+    """
+    now = time.time()
+    with dispatch_condition:
+        for key, submission in list(campaign_submissions.items()):
+            if (
+                submission["finished_at"] is not None
+                and now - submission["finished_at"] >= CAMPAIGN_DEDUP_WINDOW
+            ):
+                del campaign_submissions[key]
+        existing = campaign_submissions.get(campaign_key)
+        if existing is not None:
+            return existing, True
+        submission = {
+            "key": campaign_key,
+            "done": threading.Event(),
+            "result": None,
+            "finished_at": None,
+        }
+        campaign_submissions[campaign_key] = submission
+        return submission, False
+
+
+def release_campaign_submission(submission, result):
+    """Сохраняет результат запуска для повторных запросов и освобождает их."""
+    with dispatch_condition:
+        submission["result"] = result
+        submission["finished_at"] = time.time()
+        # Запуск, который ничего не отправил (ошибка, нет номеров, все отправки
+        # неудачны), можно сразу повторить: уже отправленные сообщения все равно
+        # отсекаются по ключам идемпотентности
+        if (
+            result is None
+            or not result["total_processed"]
+            or not result["successful_sends"]
+        ):
+            campaign_submissions.pop(submission["key"], None)
+    submission["done"].set()
+
+
+# --- Стоп-лист ---
+# Номера, отказавшиеся от рассылки, хранятся в памяти в виде множеств строк
+# 7XXXXXXXXXX (проверка O(1), сравнение без преобразований):
+# - stop_list — номера из файла STOP_LIST_FILE и добавленные во время работы
+#   (/stop_list, вебхук); новые номера дописываются в файл;
+# - sheet_stop_list — номера из диапазона STOP_LIST_RANGE Google Таблицы;
+#   множество заново строится перед каждой рассылкой и в файл не пишется,
+#   поэтому удаление номера из таблицы сразу вступает в силу.
+STOP_WORDS = {"stop", "стоп", "отписаться", "отписка"}
+stop_list = None
+sheet_stop_list = set()
+stop_list_lock = threading.Lock()
+
+
+def load_stop_list(logs_list):
+    """Загружает стоп-лист из локального файла (вызывать под stop_list_lock).
+
+    Множество присваивается только после полного успешного чтения файла.
+    При ошибке stop_list остается None, и рассылка по неполному стоп-листу
+    не начнется. Возвращает True при успехе.
+    """
+    global stop_list
+    if stop_list is not None:
+        return True
+    numbers = set()
+    if STOP_LIST_FILE and os.path.exists(STOP_LIST_FILE):
+        try:
+            with open(STOP_LIST_FILE, encoding="utf-8") as f:
+                for line in f:
+                    number = normalize_phone_number(line)
+                    if number is not None:
+                        numbers.add(number)
+        except (OSError, UnicodeDecodeError) as e:
+            log_message(
+                logs_list,
+                f"Ошибка чтения стоп-листа из файла {STOP_LIST_FILE}: {e}",
+                "error",
+            )
+            return False
+    stop_list = numbers
+    return True
+
+
+def add_to_stop_list(raw_numbers, logs_list):
+    """Добавляет номера в стоп-лист и дописывает новые в файл.
+
+    Возвращает список добавленных номеров или None, если стоп-лист не загружен.
+    """
+    added = []
+    with stop_list_lock:
+        if not load_stop_list(logs_list):
+            return None
+        for raw_number in raw_numbers:
+            number = normalize_phone_number(raw_number)
+            if number is not None and number not in stop_list:
+                stop_list.add(number)
+                added.append(number)
+        if added and STOP_LIST_FILE:
+            try:
+                with open(STOP_LIST_FILE, "a", encoding="utf-8") as f:
+                    f.write("".join(f"{number}\n" for number in added))
+            except Exception as e:
+                log_message(
+                    logs_list,
+                    f"Ошибка записи стоп-листа в файл {STOP_LIST_FILE}: {e}",
+                    "error",
+                )
+    if added:
+        log_message(logs_list, f"Добавлено номеров в стоп-лист: {len(added)}.")
+    return added
+
+
+def load_stop_list_from_sheet(service, source_spreadsheet_id, range_name, logs_list):
+    """Перечитывает номера стоп-листа из диапазона Google Таблицы."""
+    global sheet_stop_list
+    try:
+        result = (
+            service.spreadsheets()
+            .values()
+            .get(spreadsheetId=source_spreadsheet_id, range=range_name)
+            .execute()
+        )
+        raw_numbers = [row[0] for row in result.get("values", []) if row]
+        numbers = set(map(normalize_phone_number, raw_numbers))
+        numbers.discard(None)
+        with stop_list_lock:
+            sheet_stop_list = numbers
+        log_message(
+            logs_list,
+            f"Стоп-лист из таблицы (диапазон {range_name}): строк {len(raw_numbers)}, номеров {len(numbers)}.",
+        )
+        return True
+    except HttpError as err:
+        log_message(
+            logs_list,
+            f"Ошибка Google API при чтении стоп-листа из таблицы {source_spreadsheet_id}: {err}",
+            "error",
+        )
+        return False
+    except Exception as e:
+        log_message(
+            logs_list,
+            f"Непредвиденная ошибка при чтении стоп-листа из таблицы {source_spreadsheet_id}: {e}",
+            "error",
+        )
+        return False
+
+
+def is_stopped_number(phone_number, logs_list):
+    """Проверяет, находится ли номер (вида 7XXXXXXXXXX) в стоп-листе.
+
+    Если стоп-лист не удается загрузить, номер считается остановленным.
+    """
+    with stop_list_lock:
+        if not load_stop_list(logs_list):
+            return True
+    return phone_number in stop_list or phone_number in sheet_stop_list
+
+
+def filter_stop_list(phone_numbers, logs_list):
+    """Исключает номера из стоп-листа, сохраняя порядок. Возвращает (номера, исключено).
+
+    Если стоп-лист не удается загрузить, возвращает (None, 0).
+    """
+    with stop_list_lock:
+        if not load_stop_list(logs_list):
+            return None, 0
+        # filterfalse с методом множества обходится без интерпретации тела цикла
+        allowed = list(
+            itertools.filterfalse(
+                sheet_stop_list.__contains__,
+                itertools.filterfalse(stop_list.__contains__, phone_numbers),
+            )
+        )
+    return allowed, len(phone_numbers) - len(allowed)
+
+
+# --- Очередь рассылок ---
+# Все рассылки одного инстанса WhatsApp отправляются через общий диспетчер:
+# он по одному сообщению выбирает следующую кампанию (сначала по приоритету,
+# внутри одного приоритета — взвешенный round-robin) и выдерживает паузу
+# выбранной кампании, так что общий лимит инстанса делится между кампаниями.
+campaign_queue = []
+campaign_history = []
+campaign_counter = 0
+dispatch_condition = threading.Condition()
+dispatcher_thread = None
+CAMPAIGN_HISTORY_LIMIT = 50
+
+
+def create_campaign(
+    campaign_key,
+    phone_numbers,
+    message_text,
+    random_delay_enabled,
+    fixed_delay_value,
+    priority,
+    weight,
+    logs_list,
+):
+    """Создает описание кампании для очереди рассылок."""
+    return {
+        "id": None,
+        "campaign_key": campaign_key,
+        "numbers": phone_numbers,
+        "total": len(phone_numbers),
+        "position": 0,
+        "message_text": message_text,
+        "random_delay_enabled": random_delay_enabled,
+        "fixed_delay_value": fixed_delay_value,
+        "priority": priority,
+        "weight": weight,
+        "current_weight": 0,
+        "logs": logs_list,
+        "service": None,
+        "report_spreadsheet_id": None,
+        "report_sheet_title": None,
+        "reporting_enabled": False,
+        "report_buffer": [],
+        "results": create_send_results(),
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "done": threading.Event(),
+    }
+
+
+def enqueue_campaign(campaign):
+    """Ставит кампанию в очередь диспетчера и при необходимости запускает его."""
+    global campaign_counter, dispatcher_thread
+    with dispatch_condition:
+        campaign_counter += 1
+        campaign["id"] = campaign_counter
+        campaign_queue.append(campaign)
+        if dispatcher_thread is None or not dispatcher_thread.is_alive():
+            dispatcher_thread = threading.Thread(
+                target=dispatcher_loop, name="campaign-dispatcher", daemon=True
+            )
+            dispatcher_thread.start()
+        dispatch_condition.notify()
+    log_message(
+        campaign["logs"],
+        f"Рассылка #{campaign['id']} поставлена в очередь "
+        f"(приоритет: {CAMPAIGN_PRIORITIES.get(campaign['priority'], campaign['priority'])}, "
+        f"вес: {campaign['weight']}, активных рассылок: {len(campaign_queue)}).",
+    )
+    return campaign["id"]
+
+
+def pick_next_campaign():
+    """Выбирает кампанию для следующего сообщения (вызывать под dispatch_condition).
+
+    Среди кампаний с наибольшим приоритетом применяется сглаженный взвешенный
+    round-robin: кампания с весом 3 получает три сообщения на каждое сообщение
+    кампании с весом 1, при этом отправки равномерно чередуются.
+    """
+    active = [c for c in campaign_queue if c["position"] < c["total"]]
+    if not active:
+        return None
+    top_priority = max(c["priority"] for c in active)
+    candidates = [c for c in active if c["priority"] == top_priority]
+    total_weight = 0
+    for c in candidates:
+        c["current_weight"] += c["weight"]
+        total_weight += c["weight"]
+    chosen = max(candidates, key=lambda c: c["current_weight"])
+    chosen["current_weight"] -= total_weight
+    return chosen
+
+
+def process_campaign_message(campaign, index):
+    """Отправляет одно сообщение кампании и записывает результат в отчет.
+
+    Возвращает True, если был выполнен запрос к API отправки.
+    """
+    logs = campaign["logs"]
+    number = campaign["numbers"][index]
+    total = campaign["total"]
+    log_message(logs, "-" * 20)
+    log_message(
+        logs,
+        f"Рассылка #{campaign['id']}: сообщение {index + 1} из {total} на номер {number}",
+    )
+    send_key = make_send_key(campaign["campaign_key"], number)
+    if is_stopped_number(number, logs):
+        result = SendResult(number, REPORT_STATUS_OPTED_OUT, 0, 0.0, "")
+        log_message(
+            logs,
+            f"  Номер {number} находится в стоп-листе, пропускаем.",
+            "warning",
+        )
+    elif is_already_sent(send_key):
+        result = SendResult(number, REPORT_STATUS_SKIPPED, 0, 0.0, "")
+        log_message(
+            logs,
+            f"  Сообщение на {number} уже было отправлено (ключ {send_key}), пропускаем.",
+            "warning",
+        )
+    else:
+        result = send_message(API_URL, number, campaign["message_text"], logs)
+        if result.status == REPORT_STATUS_SENT:
+            mark_sent(send_key, logs)
+    append_send_result(campaign["results"], result)
+    status = result.status
+
+    sent_at = time.time()
+    append_local_report_rows(
+        campaign["report_sheet_title"],
+        [(index + 1, int(number), status, sent_at)],
+        logs,
+    )
+
+    if (
+        campaign["reporting_enabled"]
+        and campaign["service"]
+        and campaign["report_sheet_title"]
+        and campaign["report_spreadsheet_id"]
+    ):
+        report_time = datetime.fromtimestamp(sent_at).strftime("%H:%M:%S")
+        status_text = REPORT_STATUS_TITLES[status]
+        campaign["report_buffer"].append([index + 1, number, "", status_text, report_time])
+        # Пишем в ЦЕЛЕВУЮ ТАБЛИЦУ ОТЧЕТОВ пачками, а не по одной строке;
+        # остаток буфера записывается в finish_campaign
+        if len(campaign["report_buffer"]) >= REPORT_BATCH_SIZE:
+            flush_report_buffer(campaign)
+
+    # Пропущенное сообщение не расходует лимит инстанса — пауза не нужна
+    return status in (REPORT_STATUS_SENT, REPORT_STATUS_FAILED)
+
+
+def flush_report_buffer(campaign):
+    """Записывает накопленные строки отчета кампании в Google Таблицу."""
+    if not campaign.get("report_buffer"):
+        return
+    write_report_to_sheet(
+        campaign["service"],
+        campaign["report_spreadsheet_id"],
+        campaign["report_sheet_title"],
+        campaign["report_buffer"],
+        campaign["logs"],
+    )
+    campaign["report_buffer"] = []
+
+
+def pause_after_message(campaign, logs):
+    """Выдерживает паузу кампании, чье сообщение только что было отправлено."""
+    if campaign["random_delay_enabled"]:
+        current_actual_delay = random.uniform(5, 15)  # Случайная от 5 до 15 секунд
+        log_message(logs, f"  Случайная пауза: {current_actual_delay:.2f} сек...")
+        time.sleep(current_actual_delay)
+    elif campaign["fixed_delay_value"] > 0:
+        current_actual_delay = campaign["fixed_delay_value"]
+        log_message(logs, f"  Фиксированная пауза {current_actual_delay} сек...")
+        time.sleep(current_actual_delay)
+    else:
+        log_message(logs, "  Пауза не используется (0 сек).")
+
+
+def finish_campaign(campaign):
+    """Дописывает остаток отчета и убирает завершенную кампанию из очереди.
+
+    В истории остается только снимок статистики, а логи, номера и сервис
+    Google больше не удерживаются диспетчером. Событие done выставляется
+    всегда, даже если запись отчета или подсчет статистики завершились ошибкой.
+    """
+    try:
+        flush_report_buffer(campaign)
+    except Exception as e:
+        log_message(
+            campaign["logs"],
+            f"Ошибка записи остатка отчета рассылки #{campaign['id']}: {e}",
+            "error",
+        )
+    if campaign["report_sheet_title"]:
+        record_local_report_summary(
+            campaign["report_sheet_title"],
+            build_report_summary(
+                campaign["report_sheet_title"],
+                campaign["results"]["statuses"],
+                campaign["started_at"],
+                time.time(),
+            ),
+            campaign["logs"],
+        )
+    try:
+        with dispatch_condition:
+            campaign["finished_at"] = time.time()
+            if campaign in campaign_queue:
+                campaign_queue.remove(campaign)
+            campaign_history.append(campaign_stats(campaign))
+            del campaign_history[:-CAMPAIGN_HISTORY_LIMIT]
+    finally:
+        for key in ("logs", "numbers", "service", "report_buffer"):
+            campaign.pop(key, None)
+        campaign["done"].set()
+
+
+def dispatcher_loop():
+    """Фоновый поток: отправляет сообщения всех активных кампаний по очереди."""
+    while True:
+        try:
+            dispatch_next_message()
+        except Exception as e:
+            # Поток диспетчера не должен завершаться: иначе ожидающие запросы зависнут
+            print(f"Непредвиденная ошибка диспетчера рассылок: {e}")
+            time.sleep(1)
+
+
+def dispatch_next_message():
+    """Отправляет одно сообщение следующей кампании и выдерживает паузу."""
+    with dispatch_condition:
+        campaign = pick_next_campaign()
+        while campaign is None:
+            dispatch_condition.wait()
+            campaign = pick_next_campaign()
+        index = campaign["position"]
+        campaign["position"] += 1
+        if campaign["started_at"] is None:
+            campaign["started_at"] = time.time()
+
+    logs = campaign["logs"]
+    used_api = True
+    try:
+        used_api = process_campaign_message(campaign, index)
+    except Exception as e:
+        number = campaign["numbers"][index]
+        append_send_result(
+            campaign["results"],
+            SendResult(number, REPORT_STATUS_FAILED, 0, 0.0, "", str(e)),
+        )
+        log_message(
+            logs,
+            f"  Непредвиденная ошибка диспетчера при обработке сообщения {index + 1}: {e}",
+            "error",
+        )
+    finally:
+        if campaign["position"] >= campaign["total"]:
+            finish_campaign(campaign)
+
+    with dispatch_condition:
+        has_pending = any(c["position"] < c["total"] for c in campaign_queue)
+    if has_pending and used_api:
+        pause_after_message(campaign, logs)
+
+
+def campaign_stats(campaign, now=None):
+    """Возвращает прогресс, пропускную способность и ETA кампании."""
+    if now is None:
+        now = time.time()
+    total = campaign["total"]
+    summary = summarize_send_results(campaign["results"])
+    processed = summary["total"]
+    remaining = total - processed
+    elapsed = 0
+    if campaign["started_at"] is not None:
+        elapsed = (campaign["finished_at"] or now) - campaign["started_at"]
+    rate = processed / elapsed if elapsed > 0 else 0
+    if campaign["finished_at"] is not None:
+        status = "finished"
+    elif campaign["started_at"] is not None:
+        status = "running"
+    else:
+        status = "queued"
+    return {
+        "id": campaign["id"],
+        "status": status,
+        "priority": campaign["priority"],
+        "weight": campaign["weight"],
+        "report_sheet_title": campaign["report_sheet_title"],
+        "total": total,
+        "processed": processed,
+        "successful_sends": summary["successful_sends"],
+        "failed_sends": summary["failed_sends"],
+        "skipped_sends": summary["skipped_sends"],
+        "average_latency": summary["average_latency"],
+        "elapsed_seconds": round(elapsed, 1),
+        "throughput_per_minute": round(rate * 60, 2),
+        "eta_seconds": round(remaining / rate, 1) if rate > 0 else None,
+    }
+
+
 # --- Маршруты Flask ---
 @app.route("/check_access", methods=["GET"])
 def check_google_sheet_access():
@@ -471,6 +1650,138 @@ def check_google_sheet_access():
         )  # Возвращаем count: 0 при ошибке
 
 
+@app.route("/campaigns", methods=["GET"])
+def campaigns_status():
+    """Возвращает состояние активных и недавно завершенных рассылок (прогресс, скорость, ETA)."""
+    now = time.time()
+    with dispatch_condition:
+        active = [campaign_stats(c, now) for c in campaign_queue]
+        finished = list(reversed(campaign_history))
+    return jsonify({"active": active, "finished": finished})
+
+
+@app.route("/reports", methods=["GET"])
+def local_reports():
+    """Возвращает сводку по всем рассылкам из локального хранилища отчетов."""
+    reports = []
+    for entry in list_local_reports():
+        summary = dict(report_entry_summary(entry))
+        summary["message"] = entry.get("message", "")
+        summary["finished"] = "summary" in entry
+        reports.append(summary)
+    return jsonify({"reports": reports})
+
+
+@app.route("/reports/archive", methods=["POST"])
+def archive_reports():
+    """Выгружает сводку и архивирует старые листы в таблице отчетов."""
+    logs = []
+    if not REPORT_SPREADSHEET_ID or REPORT_SPREADSHEET_ID == "YOUR_REPORT_SPREADSHEET_ID_HERE":
+        return jsonify(
+            {"status": "error", "message": "Не настроен REPORT_SPREADSHEET_ID", "logs": logs}
+        )
+    try:
+        keep = int(request.form.get("keep", REPORT_KEEP_SHEETS))
+    except ValueError:
+        keep = REPORT_KEEP_SHEETS
+    if keep < 1:
+        return jsonify(
+            {"status": "error", "message": "Параметр keep должен быть не меньше 1", "logs": logs}
+        )
+    service = create_google_service(logs)
+    if not service:
+        return jsonify(
+            {"status": "error", "message": "Сервис Google Sheets недоступен", "logs": logs}
+        )
+    archived = archive_old_report_sheets(service, REPORT_SPREADSHEET_ID, keep, logs)
+    if archived is None:
+        return jsonify(
+            {"status": "error", "message": "Ошибка архивации листов", "logs": logs}
+        )
+    export_reports_summary(service, REPORT_SPREADSHEET_ID, logs)
+    return jsonify(
+        {
+            "status": "success",
+            "message": f"Архивировано листов: {archived}",
+            "archived": archived,
+            "logs": logs,
+        }
+    )
+
+
+def json_object(value):
+    """Возвращает value, если это JSON-объект (dict), иначе пустой словарь."""
+    return value if isinstance(value, dict) else {}
+
+
+@app.route("/stop_list", methods=["GET", "POST"])
+def stop_list_route():
+    """GET — размер стоп-листа, POST — добавление номеров (поле number или numbers)."""
+    logs = []
+    added = []
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if data is None:
+            data = request.form
+        elif not isinstance(data, dict):
+            return jsonify(
+                {"status": "error", "message": "Ожидается JSON-объект с полем number или numbers"}
+            ), 400
+        raw_numbers = []
+        if data.get("number"):
+            raw_numbers.append(data.get("number"))
+        numbers = data.get("numbers")
+        if isinstance(numbers, str):
+            raw_numbers.extend(re.split(r"[,;\s]+", numbers))
+        elif isinstance(numbers, list):
+            raw_numbers.extend(numbers)
+        added = add_to_stop_list(raw_numbers, logs)
+    with stop_list_lock:
+        loaded = load_stop_list(logs)
+        count = len(stop_list) if loaded else 0
+        sheet_count = len(sheet_stop_list)
+    if not loaded:
+        return jsonify(
+            {"status": "error", "message": "Не удалось загрузить стоп-лист", "logs": logs}
+        ), 500
+    return jsonify(
+        {
+            "status": "success",
+            "count": count,
+            "sheet_count": sheet_count,
+            "added": added,
+            "logs": logs,
+        }
+    )
+
+
+@app.route("/webhook/incoming", methods=["POST"])
+def incoming_webhook():
+    """Принимает входящие сообщения от Green-API и добавляет в стоп-лист ответивших "STOP"."""
+    if WEBHOOK_TOKEN and request.headers.get("Authorization") != f"Bearer {WEBHOOK_TOKEN}":
+        return jsonify({"status": "error", "message": "Неверный токен"}), 403
+    data = json_object(request.get_json(silent=True))
+    if data.get("typeWebhook") != "incomingMessageReceived":
+        return jsonify({"status": "ignored"})
+    message_data = json_object(data.get("messageData"))
+    text = (
+        json_object(message_data.get("textMessageData")).get("textMessage")
+        or json_object(message_data.get("extendedTextMessageData")).get("text")
+        or ""
+    )
+    if not isinstance(text, str) or text.strip().strip("!.").lower() not in STOP_WORDS:
+        return jsonify({"status": "ignored"})
+    chat_id = json_object(data.get("senderData")).get("chatId")
+    if not isinstance(chat_id, str) or not chat_id.endswith("@c.us"):
+        return jsonify({"status": "ignored"})  # Групповые чаты не обрабатываем
+    logs = []
+    added = add_to_stop_list([chat_id.split("@")[0]], logs)
+    if added is None:
+        # Ошибка 500 — Green-API повторит доставку вебхука
+        return jsonify({"status": "error", "message": "Не удалось загрузить стоп-лист"}), 500
+    return jsonify({"status": "success", "added": added})
+
+
 @app.route("/")
 def index():
     error = None
@@ -480,12 +1791,64 @@ def index():
         "index.html",
         default_delay=DEFAULT_DELAY_BETWEEN_MESSAGES,
         default_message=DEFAULT_MESSAGE_TEXT,
+        default_weight=DEFAULT_CAMPAIGN_WEIGHT,
+        priorities=CAMPAIGN_PRIORITIES,
         error=error,
     )
 
 
 @app.route("/send", methods=["POST"])
 def send_messages_route():
+    message_text = request.form.get("message", DEFAULT_MESSAGE_TEXT)
+    campaign_key = make_campaign_key(SPREADSHEET_ID, RANGE_NAME, message_text)
+    submission, is_duplicate = claim_campaign_submission(campaign_key)
+
+    if is_duplicate:
+        logs = []
+        if submission["done"].is_set():
+            log_message(
+                logs,
+                f"Такая же рассылка (тот же текст и источник номеров) уже выполнялась менее {CAMPAIGN_DEDUP_WINDOW} сек. назад. Повторный запуск отклонен, ниже показаны ее результаты.",
+                "warning",
+            )
+        else:
+            log_message(
+                logs,
+                "Такая же рассылка (тот же текст и источник номеров) уже выполняется. Повторный запуск не создан, ожидаем ее завершения.",
+                "warning",
+            )
+        submission["done"].wait()
+        result = submission["result"]
+        if result is None:
+            log_message(
+                logs,
+                "Исходная рассылка завершилась с ошибкой. Запустите рассылку повторно.",
+                "error",
+            )
+            return render_template(
+                "results.html",
+                logs=logs,
+                successful_sends=0,
+                failed_sends=0,
+                skipped_sends=0,
+                total_processed=0,
+                message_text=message_text,
+                delay_info={"type": "Фиксированная", "value": 0},
+                report_info={"sheet_title": None, "status": "N/A", "target_file_id": "N/A"},
+            )
+        result = dict(result, logs=logs + result["logs"])
+        return render_template("results.html", **result)
+
+    result = None
+    try:
+        result = run_send_campaign(message_text, campaign_key)
+    finally:
+        release_campaign_submission(submission, result)
+    return render_template("results.html", **result)
+
+
+def run_send_campaign(message_text, campaign_key):
+    """Выполняет рассылку и возвращает параметры для шаблона results.html."""
     logs = []
     log_message(logs, "Запрос на запуск рассылки получен.")
     service = None
@@ -511,18 +1874,17 @@ def send_messages_route():
 
     if not API_URL or API_URL == "TOKEN":
         log_message(logs, "Критическая ошибка: Не указан TOKEN в .env!", "error")
-        return render_template(
-            "results.html",
+        return dict(
             logs=logs,
             successful_sends=0,
             failed_sends=0,
+            skipped_sends=0,
             total_processed=0,
             message_text="N/A",
             delay_info=delay_info_for_template,
             report_info=report_info,
         )
 
-    message_text = request.form.get("message", DEFAULT_MESSAGE_TEXT)
     random_delay_enabled = request.form.get("random_delay_enabled") == "yes"
     fixed_delay_value = 0  # Для хранения значения фиксированной задержки
 
@@ -550,6 +1912,21 @@ def send_messages_route():
             )
             delay_info_for_template["value"] = fixed_delay_value
 
+    try:
+        priority = int(request.form.get("priority", DEFAULT_CAMPAIGN_PRIORITY))
+        if priority not in CAMPAIGN_PRIORITIES:
+            priority = DEFAULT_CAMPAIGN_PRIORITY
+    except ValueError:
+        priority = DEFAULT_CAMPAIGN_PRIORITY
+    try:
+        weight = max(1, int(request.form.get("weight", DEFAULT_CAMPAIGN_WEIGHT)))
+    except ValueError:
+        weight = DEFAULT_CAMPAIGN_WEIGHT
+    log_message(
+        logs,
+        f"Приоритет рассылки: {CAMPAIGN_PRIORITIES[priority]}, вес: {weight}.",
+    )
+
     log_message(logs, f'Текст сообщения для отправки: "{message_text}"')
 
     service = create_google_service(logs)
@@ -559,6 +1936,33 @@ def send_messages_route():
         phone_numbers = get_phone_numbers_from_sheet(
             service, SPREADSHEET_ID, RANGE_NAME, logs
         )
+        if (
+            phone_numbers
+            and STOP_LIST_RANGE
+            and not load_stop_list_from_sheet(
+                service, STOP_LIST_SPREADSHEET_ID, STOP_LIST_RANGE, logs
+            )
+        ):
+            log_message(
+                logs,
+                "Не удалось загрузить стоп-лист из Google Таблицы. Рассылка не может быть выполнена без стоп-листа.",
+                "error",
+            )
+            phone_numbers = None
+        if phone_numbers:
+            phone_numbers, stopped_count = filter_stop_list(phone_numbers, logs)
+            if phone_numbers is None:
+                log_message(
+                    logs,
+                    "Не удалось загрузить стоп-лист из файла. Рассылка не может быть выполнена без стоп-листа.",
+                    "error",
+                )
+            elif stopped_count:
+                log_message(
+                    logs,
+                    f"Исключено номеров из стоп-листа: {stopped_count}. Осталось для отправки: {len(phone_numbers)}.",
+                    "warning",
+                )
     else:
         log_message(
             logs,
@@ -568,6 +1972,8 @@ def send_messages_route():
 
     successful_sends = 0
     failed_sends = 0
+    skipped_sends = 0
+    average_latency = 0
     total_processed = 0
 
     if phone_numbers is None:
@@ -581,8 +1987,10 @@ def send_messages_route():
             "warning",
         )
     else:
+        report_sheet_title = reserve_local_report(
+            message_text, len(phone_numbers), logs
+        )
         if service and actual_report_spreadsheet_id:
-            report_sheet_title = datetime.now().strftime("%d.%m.%y %H-%M-%S")
             report_info["sheet_title"] = report_sheet_title
             # Создаем лист в ЦЕЛЕВОЙ ТАБЛИЦЕ ОТЧЕТОВ
             if create_new_report_sheet(
@@ -633,75 +2041,59 @@ def send_messages_route():
         total_processed = len(phone_numbers)
         log_message(logs, f"Начинаем отправку {total_processed} сообщений...")
 
-        for i, number in enumerate(phone_numbers):
-            log_message(logs, "-" * 20)
-            log_message(
-                logs, f"Сообщение {i + 1} из {total_processed} на номер {number}"
-            )
-            success_send = send_message(API_URL, number, message_text, logs)
-
-            if (
-                reporting_to_google_sheets_enabled
-                and service
-                and report_sheet_title
-                and actual_report_spreadsheet_id
-            ):
-                report_time = datetime.now().strftime("%H:%M:%S")
-                status_text = "Отправлено" if success_send else "Не отправлено"
-                report_row = [i + 1, number, "", status_text, report_time]
-                # Пишем в ЦЕЛЕВУЮ ТАБЛИЦУ ОТЧЕТОВ
-                write_report_to_sheet(
-                    service,
-                    actual_report_spreadsheet_id,
-                    report_sheet_title,
-                    [report_row],
-                    logs,
-                )
-
-            if success_send:
-                successful_sends += 1
-            else:
-                failed_sends += 1
-
-            if i < total_processed - 1:
-                current_actual_delay = 0
-                if random_delay_enabled:
-                    current_actual_delay = random.uniform(
-                        5, 15
-                    )  # Случайная от 5 до 15 секунд
-                    log_message(
-                        logs, f"  Случайная пауза: {current_actual_delay:.2f} сек..."
-                    )
-                    time.sleep(current_actual_delay)
-                elif fixed_delay_value > 0:
-                    current_actual_delay = fixed_delay_value
-                    log_message(
-                        logs, f"  Фиксированная пауза {current_actual_delay} сек..."
-                    )
-                    time.sleep(current_actual_delay)
-                else:
-                    log_message(logs, "  Пауза не используется (0 сек).")
+        campaign = create_campaign(
+            campaign_key,
+            phone_numbers,
+            message_text,
+            random_delay_enabled,
+            fixed_delay_value,
+            priority,
+            weight,
+            logs,
+        )
+        campaign["service"] = service
+        campaign["report_spreadsheet_id"] = actual_report_spreadsheet_id
+        campaign["report_sheet_title"] = report_sheet_title
+        campaign["reporting_enabled"] = reporting_to_google_sheets_enabled
+        enqueue_campaign(campaign)
+        # Ждем, пока диспетчер отправит все сообщения этой рассылки
+        campaign["done"].wait()
+        stats = campaign_stats(campaign)
+        successful_sends = stats["successful_sends"]
+        failed_sends = stats["failed_sends"]
+        skipped_sends = stats["skipped_sends"]
+        average_latency = stats["average_latency"]
 
         log_message(logs, "=" * 30)
         log_message(logs, "Рассылка завершена.")
         log_message(
             logs,
-            f"Итого: Успешно отправлено: {successful_sends}, Не удалось отправить: {failed_sends}",
+            f"Итого: Успешно отправлено: {successful_sends}, Не удалось отправить: {failed_sends}, Пропущено (дубликаты и стоп-лист): {skipped_sends}",
+        )
+        log_message(
+            logs,
+            f"Длительность: {stats['elapsed_seconds']} сек., скорость: {stats['throughput_per_minute']} сообщ./мин., среднее время ответа API: {stats['average_latency']} сек.",
+        )
+        log_message(
+            logs,
+            f"Локальный отчет сохранен в папке: {os.path.join(REPORTS_DIR, report_sheet_title)}",
         )
         if reporting_to_google_sheets_enabled:
             log_message(
                 logs,
                 f"Отчет сохранен в Google Таблице (ID: {actual_report_spreadsheet_id}) на листе: '{report_sheet_title}'",
             )
+            export_reports_summary(service, actual_report_spreadsheet_id, logs)
         log_message(logs, "=" * 30)
     
     save_logs_to_file(logs, report_sheet_title)
 
-    return render_template(
-        "results.html",
+    return dict(
         logs=logs,
         successful_sends=successful_sends,
         failed_sends=failed_sends,
+        skipped_sends=skipped_sends,
+        average_latency=average_latency,
         total_processed=total_processed,
         message_text=message_text,
         delay_info=delay_info_for_template,  # Передаем словарь с информацией о задержке